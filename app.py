@@ -1,130 +1,366 @@
+import html
+import re
 import requests
-from bs4 import BeautifulSoup
-import pandas as pd
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
+from selectolax.lexbor import LexborHTMLParser
+import orjson
+import csv
 import time
 import os
-from flask import Flask, jsonify, request
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from flask import Flask, Response, jsonify, request
 
 # Create Flask app
 app = Flask(__name__)
 
-def scrape_bitcoin_etf_data(url):
-    """Scrape Bitcoin ETF data from the specified URL using BeautifulSoup."""
-    
-    # Set headers to mimic a real browser
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Accept-Encoding': 'gzip, deflate',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',
-    }
+# Columns of the ETF flow table, shared by every parse so row dicts reuse the same key objects
+TABLE_HEADERS = ('Date', 'IBIT', 'FBTC', 'BITB', 'ARKB', 'BTCO', 'EZBC', 'BRRR', 'HODL', 'BTCW', 'GBTC', 'BTC', 'Total')
+
+# Set headers to mimic a real browser
+REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    # Advertise every codec urllib3 can decode here (br/zstd when installed)
+    'Accept-Encoding': ACCEPT_ENCODING,
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+}
+
+# Shared HTTP session so repeated scrapes reuse the pooled keep-alive connection
+SESSION = requests.Session()
+SESSION.headers.update(REQUEST_HEADERS)
+adapter = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 502, 503, 504]),
+)
+SESSION.mount('https://', adapter)
+
+# In-process cache of the last successful scrape; Farside only publishes daily.
+# 'fetched_at' is the UTC time the payload was last confirmed upstream;
+# 'etag' and 'last_modified' are the origin's validators for conditional GETs;
+# 'failures' and 'retry_at' pause background revalidation after failed scrapes.
+_CACHE = {'at': 0.0, 'payload': None, 'fetched_at': None, 'etag': None, 'last_modified': None, 'failures': 0, 'retry_at': 0.0}
+_TTL = 900  # seconds
+_MAX_STALE = 16 * _TTL  # seconds; older copies are never served without a successful refresh
+_FAILURE_BACKOFF = 30  # seconds, doubled after each consecutive failure
+_MAX_FAILURE_BACKOFF = 900  # seconds
+_CACHE_LOCK = threading.Lock()
+# Future for the refresh currently in flight; concurrent callers share it
+_inflight = None
+# Daemon thread started for background revalidation, if any
+_refresh_thread = None
+_INFLIGHT_LOCK = threading.Lock()
+
+# Background writer for output files so callers don't block on disk I/O
+EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+def fetch_etf_page(url, cache=None):
+    """Fetch the ETF page, sending conditional headers when a cache is given.
+    
+    Returns the response (status 200 or 304), or None if the request failed.
+    """
+    conditional_headers = {}
+    if cache is not None and cache['payload'] is not None:
+        if cache['etag']:
+            conditional_headers['If-None-Match'] = cache['etag']
+        if cache['last_modified']:
+            conditional_headers['If-Modified-Since'] = cache['last_modified']
     
     try:
         # Make the request
-        response = requests.get(url, headers=headers, timeout=10)
+        response = SESSION.get(url, headers=conditional_headers, timeout=30)
+        if response.status_code == 304:
+            print("Website not modified since last scrape")
+            return response
         response.raise_for_status()  # Raise an exception for bad status codes
+    except requests.exceptions.RequestException as e:
+        print(f"Error making request: {e}")
+        return None
+    
+    print("Website loaded successfully!")
+    return response
+
+def etf_table_slice(content):
+    """Return only the ``<table class="etf">`` markup from the page bytes.
+    
+    Falls back to the whole page if the table can't be located by a plain search.
+    """
+    marker = content.find(b'class="etf"')
+    if marker == -1:
+        return content
+    start = content.rfind(b'<table', 0, marker)
+    end = content.find(b'</table>', marker)
+    if start == -1 or end == -1 or b'>' in content[start:marker]:
+        return content
+    return content[start:end + len(b'</table>')]
+
+# Patterns for the regex fast path over the plain <tr>/<td>/<span class="tabletext"> table shape
+ROW_RE = re.compile(rb'<tr[^>]*>(.*?)</tr>', re.S | re.I)
+ROW_START_RE = re.compile(rb'<tr[\s>]', re.I)
+# Surrounding ASCII whitespace is trimmed by the pattern itself, so plain cells need no strip()
+CELL_RE = re.compile(rb'<td[^>]*>\s*(?:<span[^>]*class="tabletext"[^>]*>)?\s*([^<]*?)\s*(?:</span>)?\s*</td>', re.I)
+CELL_START_RE = re.compile(rb'<td[\s>]', re.I)
+
+def parse_rows_fast(table_html, width):
+    """Extract data rows from the ETF table markup with regexes, without building a DOM.
+    
+    Returns None if the markup doesn't have the expected shape, so callers can
+    fall back to the DOM parser.
+    """
+    rows = ROW_RE.findall(table_html)
+    if len(rows) < 2 or len(rows) != len(ROW_START_RE.findall(table_html)):
+        return None
+    
+    data = []
+    for row in rows[1:]:  # Skip header row
+        cells = CELL_RE.findall(row)
+        if len(cells) != len(CELL_START_RE.findall(row)):
+            # Some cell holds markup other than a single 'tabletext' span
+            return None
+        if len(cells) >= width:
+            # Only cells with entities or non-ASCII bytes (e.g. &nbsp;) need unescaping and re-stripping
+            data.append([
+                cell.decode('ascii') if cell.isascii() and b'&' not in cell
+                else html.unescape(cell.decode('utf-8', 'replace')).strip()
+                for cell in cells[:width]
+            ])
+    
+    return data or None
+
+def parse_rows_dom(table_html, width):
+    """Extract data rows from the ETF table markup with selectolax.
+    
+    Returns None if the table or its rows can't be found.
+    """
+    tree = LexborHTMLParser(table_html)
+    
+    # Find the table with class 'etf'
+    table = tree.css_first('table.etf')
+    if table is None:
+        print("Table with class 'etf' not found")
+        return None
+    
+    # Find all rows in the table
+    rows = table.css('tr')
+    if not rows:
+        print("No rows found in table")
+        return None
+    
+    # Skip the header row and extract the text of the first `width` cells
+    # of each data row, preferring the 'tabletext' span inside a cell
+    cells_per_row = (
+        [
+            (span.text() if (span := cell.css_first('span.tabletext')) is not None else cell.text()).strip()
+            for cell in row.css('td')[:width]
+        ]
+        for row in rows[1:]
+    )
+    
+    # Only keep rows that have the right number of columns
+    return [row_data for row_data in cells_per_row if len(row_data) == width]
+
+# Tables that parse_rows_fast must either parse exactly like parse_rows_dom or
+# decline with None, paired with whether the fast path is expected to take them
+_FAST_PATH_FIXTURES = (
+    # Padded cells, an &nbsp; cell, an extra trailing cell and a short total row
+    (b'<table class="etf"><tr><th>Date</th><th>IBIT</th><th>Total</th></tr>'
+     b'<tr><td> <span class="tabletext"> 11 Jan 2024 </span> </td>'
+     b'<td><span class="tabletext">&nbsp;</span></td><td>\n(1.5)\n</td></tr>'
+     b'<tr><td><span class="tabletext">12 Jan 2024</span></td><td>-</td>'
+     b'<td><span class="tabletext">2,310.4</span></td><td>extra</td></tr>'
+     b'<tr><td>Total</td><td>3</td></tr></table>', True),
+    # Unclosed <td>
+    (b'<table class="etf"><tr><th>Date</th></tr>'
+     b'<tr><td>11 Jan 2024<td>1</td><td>2</td></tr></table>', False),
+    # Unclosed <tr>
+    (b'<table class="etf"><tr><th>Date</th></tr>'
+     b'<tr><td>11 Jan 2024</td><td>1</td><td>2</td>'
+     b'<tr><td>12 Jan 2024</td><td>3</td><td>4</td></tr></table>', False),
+    # Cell with nested markup
+    (b'<table class="etf"><tr><th>Date</th></tr>'
+     b'<tr><td>11 Jan 2024</td><td><b>1</b></td><td>2</td></tr></table>', False),
+)
+
+def fast_path_agrees():
+    """Check parse_rows_fast against parse_rows_dom on the fixture tables."""
+    for table_html, takes_fast_path in _FAST_PATH_FIXTURES:
+        fast = parse_rows_fast(table_html, 3)
+        if (fast is not None) != takes_fast_path:
+            return False
+        if fast is not None and fast != parse_rows_dom(table_html, 3):
+            return False
+    return True
+
+# Checked once at import; a regex change that drifts from selectolax disables the fast path
+FAST_PATH_ENABLED = fast_path_agrees()
+if not FAST_PATH_ENABLED:
+    print("Regex fast path disagrees with selectolax on fixtures, using selectolax only")
+
+def parse_etf_table(content):
+    """Parse the ETF flow table out of the page HTML.
+    
+    Uses the regex fast path when the table has the expected plain shape and
+    falls back to selectolax otherwise.
+    """
+    try:
+        width = len(TABLE_HEADERS)
         
-        print("Website loaded successfully!")
-        
-        # Parse the HTML content
-        soup = BeautifulSoup(response.content, 'html.parser')
-        
-        # Define the headers
-        table_headers = ['Date', 'IBIT', 'FBTC', 'BITB', 'ARKB', 'BTCO', 'EZBC', 'BRRR', 'HODL', 'BTCW', 'GBTC', 'BTC', 'Total']
-        data = []
-        
-        # Find the table with class 'etf'
-        table = soup.find('table', class_='etf')
-        if not table:
-            print("Table with class 'etf' not found")
-            return None, None
-        
-        # Find all rows in the table
-        rows = table.find_all('tr')
-        if not rows:
-            print("No rows found in table")
-            return None, None
+        # Only the ETF table is needed, not the whole page
+        table_html = etf_table_slice(content)
         
-        # Skip the header row and process data rows
-        for row in rows[1:]:  # Skip header row
-            # Find all td elements in the row
-            cells = row.find_all('td')
-            if cells:
-                # Create a list for this row's data
-                row_data = []
-                
-                # Extract text from each cell (should correspond to our headers)
-                for i, cell in enumerate(cells):
-                    if i < len(table_headers):  # Ensure we don't exceed our header count
-                        # Look for span with class 'tabletext' inside the cell
-                        span = cell.find('span', class_='tabletext')
-                        if span:
-                            row_data.append(span.get_text().strip())
-                        else:
-                            # If no span, get the cell text directly
-                            row_data.append(cell.get_text().strip())
-                
-                # Only add rows that have the right number of columns
-                if len(row_data) == len(table_headers):
-                    data.append(row_data)
+        # Only take the fast path when etf_table_slice found the <table class="etf"> slice;
+        # on its whole-page fallback ROW_RE would pick up rows from other markup
+        data = None
+        if FAST_PATH_ENABLED and table_html.startswith(b'<table'):
+            data = parse_rows_fast(table_html, width)
+        if data is None:
+            print("Fast path unavailable, parsing table with selectolax")
+            data = parse_rows_dom(table_html, width)
         
         if not data:
             print("No data found in table")
             return None, None
             
-        return table_headers, data
+        return TABLE_HEADERS, data
         
-    except requests.exceptions.RequestException as e:
-        print(f"Error making request: {e}")
-        return None, None
     except Exception as e:
         print(f"Error during scraping: {e}")
         return None, None
 
-def save_to_json(headers, data, filename='bitcoin_etf_flows.json'):
-    """Save the scraped data to a JSON file."""
+def scrape_bitcoin_etf_data(url):
+    """Scrape Bitcoin ETF data from the specified URL."""
+    response = fetch_etf_page(url)
+    if response is None:
+        return None, None
+    return parse_etf_table(response.content)
+
+def _write_files(headers, data, json_data, filepath, csv_filepath):
+    """Write the records to a JSON file and the raw rows to a CSV file."""
+    # Ensure output directory exists
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    
+    # Save to JSON file in output directory
+    with open(filepath, 'wb') as json_file:
+        json_file.write(orjson.dumps(json_data, option=orjson.OPT_INDENT_2))
+    
+    print(f"\nData has been saved to {filepath}")
+    
+    # Print summary
+    print(f"Total rows saved to JSON: {len(data)}")
+    
+    # Also save a CSV version for easier viewing
+    # Match pandas' to_csv output: UTF-8 with '\n' line endings
+    with open(csv_filepath, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file, lineterminator='\n')
+        writer.writerow(headers)
+        writer.writerows(data)
+    print(f"CSV version saved to {csv_filepath}")
+
+def save_to_json(headers, data, filename='bitcoin_etf_flows.json', persist=False):
+    """Write the scraped data to JSON and CSV files when persist is set.
+    
+    Records are built here and written on EXECUTOR in the background. Returns
+    the Future for that write, or None when persist is off or there is no data;
+    with persist off nothing is built or printed.
+    """
+    if not persist:
+        return None
+    
     if headers and data:
-        # Create a list of dictionaries, each representing a row
-        json_data = []
-        for row in data:
-            # Create a dictionary with header:value pairs
-            row_dict = {headers[i]: value for i, value in enumerate(row)}
-            json_data.append(row_dict)
+        # Create a list of dictionaries, each representing a row of header:value pairs
+        json_data = [dict(zip(headers, row)) for row in data]
         
         # Print sample data to console (first 3 rows)
         print(f"Sample data (first 3 rows):")
         for i, row in enumerate(json_data[:3]):
             print(f"Row {i+1}: {row}")
         
-        # Ensure output directory exists
         output_dir = '/app/output'
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # Save to JSON file in output directory
         filepath = os.path.join(output_dir, filename)
-        with open(filepath, 'w') as json_file:
-            json.dump(json_data, json_file, indent=4)
-        
-        print(f"\nData has been saved to {filepath}")
-        
-        # Print summary
-        print(f"Total rows saved to JSON: {len(data)}")
-        
-        # Also save a CSV version for easier viewing
-        csv_filename = filename.replace('.json', '.csv')
-        csv_filepath = os.path.join(output_dir, csv_filename)
-        df = pd.DataFrame(json_data)
-        df.to_csv(csv_filepath, index=False)
-        print(f"CSV version saved to {csv_filepath}")
-        
-        return json_data
+        csv_filepath = os.path.join(output_dir, filename.replace('.json', '.csv'))
+        return EXECUTOR.submit(_write_files, headers, data, json_data, filepath, csv_filepath)
     else:
         print("No data to save")
         return None
 
+def refresh_cache(url):
+    """Scrape the page into the in-process cache.
+    
+    Returns the cached payload, or None if the scrape failed. A failure pushes
+    back the next background revalidation (see scrape_endpoint).
+    """
+    print(f"Scraping data from: {url}")
+    print("Starting Bitcoin ETF data scraper...")
+    
+    response = fetch_etf_page(url, _CACHE)
+    
+    if response is not None and response.status_code == 304:
+        # Unchanged upstream: keep the cached payload and skip parsing
+        with _CACHE_LOCK:
+            _CACHE['at'] = time.monotonic()
+            _CACHE['fetched_at'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+            _CACHE['failures'] = 0
+            json_data = _CACHE['payload']
+        print("✅ Cached data is still current")
+        return json_data
+    
+    headers, data = parse_etf_table(response.content) if response is not None else (None, None)
+    if not (headers and data):
+        with _CACHE_LOCK:
+            _CACHE['failures'] += 1
+            backoff = min(_FAILURE_BACKOFF * 2 ** (_CACHE['failures'] - 1), _MAX_FAILURE_BACKOFF)
+            _CACHE['retry_at'] = time.monotonic() + backoff
+        print(f"❌ Failed to scrape data, pausing background refreshes for {backoff}s")
+        return None
+    
+    # The API serves the columnar form and doesn't write output files
+    json_data = {'columns': list(headers), 'rows': data}
+    with _CACHE_LOCK:
+        _CACHE['payload'] = json_data
+        _CACHE['fetched_at'] = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        _CACHE['etag'] = response.headers.get('ETag')
+        _CACHE['last_modified'] = response.headers.get('Last-Modified')
+        _CACHE['at'] = time.monotonic()
+        _CACHE['failures'] = 0
+    print("✅ Scraping completed successfully!")
+    return json_data
+
+def refresh_cache_once(url):
+    """Run refresh_cache, or join the refresh already in flight.
+    
+    Returns a Future resolving to refresh_cache's result, so concurrent
+    callers all get the payload from a single scrape.
+    """
+    global _inflight
+    with _INFLIGHT_LOCK:
+        if _inflight is not None:
+            return _inflight
+        future = _inflight = Future()
+    
+    try:
+        future.set_result(refresh_cache(url))
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with _INFLIGHT_LOCK:
+            _inflight = None
+    return future
+
+def start_background_refresh(url):
+    """Start refresh_cache_once on a daemon thread unless one is already pending."""
+    global _refresh_thread
+    with _INFLIGHT_LOCK:
+        if _inflight is not None or (_refresh_thread is not None and _refresh_thread.is_alive()):
+            return
+        _refresh_thread = threading.Thread(target=refresh_cache_once, args=(url,), daemon=True)
+        _refresh_thread.start()
+
 # Flask routes
 @app.route('/')
 def home():
@@ -148,30 +384,57 @@ def scrape_endpoint():
     """Scrape Bitcoin ETF data and return as JSON."""
     url = "https://farside.co.uk/bitcoin-etf-flow-all-data"
     
-    print(f"Scraping data from: {url}")
-    print("Starting Bitcoin ETF data scraper...")
-    
-    headers, data = scrape_bitcoin_etf_data(url)
+    with _CACHE_LOCK:
+        json_data = _CACHE['payload']
+        fetched_at = _CACHE['fetched_at']
+        now = time.monotonic()
+        age = now - _CACHE['at']
+        cooling_down = now < _CACHE['retry_at']
     
-    if headers and data:
-        json_data = save_to_json(headers, data)
-        print("✅ Scraping completed successfully!")
+    stale = age >= _TTL
+    if json_data is not None and age < _MAX_STALE:
+        with _INFLIGHT_LOCK:
+            refreshing = _inflight is not None
         
-        return jsonify({
-            "status": "success",
-            "message": "Bitcoin ETF data scraped successfully",
-            "total_rows": len(data),
-            "data": json_data
-        })
+        if not stale:
+            print("Serving cached Bitcoin ETF data")
+        elif cooling_down:
+            # A recent refresh failed; keep serving the stale copy until the cooldown ends
+            print("Serving stale Bitcoin ETF data, background refresh paused after failure")
+        elif refreshing:
+            print("Serving stale Bitcoin ETF data, refresh already in progress")
+        else:
+            # Serve the stale copy now and revalidate without blocking this worker
+            print("Serving stale Bitcoin ETF data while refreshing in background")
+            start_background_refresh(url)
     else:
-        print("❌ Failed to scrape data")
-        return jsonify({
-            "status": "error",
-            "message": "Failed to scrape Bitcoin ETF data"
-        }), 500
+        # Nothing cached yet, or the cached copy is too old to serve: wait on the
+        # scrape, sharing it with any concurrent callers
+        json_data = refresh_cache_once(url).result()
+        if json_data is None:
+            return jsonify({
+                "status": "error",
+                "message": "Failed to scrape Bitcoin ETF data"
+            }), 500
+        with _CACHE_LOCK:
+            fetched_at = _CACHE['fetched_at']
+        stale = False
+    
+    # Columnar payload: each row is a list of values in the order of "columns".
+    # "stale" marks a copy older than the cache TTL served while revalidating.
+    # Encoded with orjson since this is the largest response the API sends.
+    return Response(orjson.dumps({
+        "status": "success",
+        "message": "Bitcoin ETF data scraped successfully",
+        "fetched_at": fetched_at,
+        "stale": stale,
+        "total_rows": len(json_data['rows']),
+        "columns": json_data['columns'],
+        "rows": json_data['rows']
+    }), mimetype='application/json')
 
 def main():
-    """Main function to run the scraping process with BeautifulSoup."""
+    """Main function to run the scraping process."""
     url = "https://farside.co.uk/bitcoin-etf-flow-all-data"
     
     print(f"Scraping data from: {url}")
@@ -180,7 +443,13 @@ def main():
     headers, data = scrape_bitcoin_etf_data(url)
     
     if headers and data:
-        save_to_json(headers, data)
+        # Wait for the background file writes before reporting completion
+        try:
+            save_to_json(headers, data, persist=True).result()
+        except Exception as e:
+            print(f"Error writing output files: {e}")
+            print("❌ Failed to save data")
+            return
         print("✅ Scraping completed successfully!")
     else:
         print("❌ Failed to scrape data")